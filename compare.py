@@ -1,12 +1,52 @@
 #!/usr/bin/env python3
 import os
+import json
+import time
+import queue
+import shutil
+import hashlib
+import threading
 import subprocess
+import re
 import fnmatch
 import difflib
 import argparse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import repeat, zip_longest
 from pathlib import Path
-from dataclasses import dataclass
-from typing import Optional, Set, List
+from dataclasses import asdict, dataclass
+from typing import Callable, Dict, Iterator, Optional, List, Tuple, Union
+
+CHUNK_SIZE = 128 * 1024
+# Bigger files are (almost always) generated, and not worth a line diff
+DEFAULT_MAX_BYTES = 1_000_000
+# How much of a file to check for NUL bytes when deciding it is binary
+BINARY_SNIFF_BYTES = 8 * 1024
+# Below this many shared files the process pool startup costs more than it saves
+PARALLEL_THRESHOLD = 4
+# Directory listing is syscall-bound, so threads overlap it despite the GIL
+WALK_WORKERS = min(32, (os.cpu_count() or 1) + 4)
+SKIP_DIRS = {"__pycache__", "build", "dist"}
+# (st_size, st_mtime_ns) gathered while walking, or None if stat failed
+FileStat = Optional[Tuple[int, int]]
+# Files with more lines than this on both sides are diffed by git, whose C
+# Myers implementation is far faster than anything in-process
+GIT_DIFF_MIN_LINES = 2000
+# Pairs where one side has this many times more lines than the other are
+# reported as unrelated without running a diff
+LENGTH_RATIO_CUTOFF = 10
+CACHE_VERSION = 10
+# mtimes on these can't be trusted to change with content, so skip caching
+NETWORK_FILESYSTEMS = {
+    "nfs",
+    "nfs4",
+    "cifs",
+    "smb3",
+    "smbfs",
+    "afs",
+    "9p",
+    "fuse.sshfs",
+}
 
 
 @dataclass
@@ -18,8 +58,111 @@ class FileComparison:
     deletions: int = 0
 
 
+# Sources are resolved on separate threads: one lock per clone directory stops
+# two threads cloning the same URL at once, and one guards index.json
+_clone_locks: Dict[str, threading.Lock] = {}
+_clone_locks_guard = threading.Lock()
+_repo_index_lock = threading.Lock()
+
+
+class Cache:
+    """Comparison results from earlier runs, persisted as JSON"""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.entries = {}
+        self.dirty = False
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") == CACHE_VERSION:
+                self.entries = data["entries"]
+        except (OSError, ValueError, KeyError, AttributeError):
+            pass
+
+    def get(self, key: str, rel_path: str, stamp: list) -> Optional[FileComparison]:
+        """A hit needs the sizes and mtimes in stamp to match the stored ones"""
+        entry = self.entries.get(key)
+        if entry is None or entry["stamp"] != stamp:
+            return None
+        return FileComparison(rel_path, **entry["result"])
+
+    def put(self, key: str, stamp: list, comp: FileComparison) -> None:
+        result = asdict(comp)
+        del result["path"]
+        self.entries[key] = {"stamp": stamp, "result": result}
+        self.dirty = True
+
+    def prune(self, dir1: str, dir2: str, is_gone: Callable[[str], bool]) -> None:
+        """Drop entries for this directory pair whose file is_gone"""
+        pair = [os.path.abspath(dir1), os.path.abspath(dir2)]
+        stale = []
+        for key in self.entries:
+            fields = json.loads(key)
+            if fields[:2] == pair and is_gone(fields[2]):
+                stale.append(key)
+        for key in stale:
+            del self.entries[key]
+        self.dirty = self.dirty or bool(stale)
+
+    def save(self) -> None:
+        if not self.dirty:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(self.path.name + f".{os.getpid()}.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"version": CACHE_VERSION, "entries": self.entries}, f)
+        os.replace(tmp_path, self.path)
+        self.dirty = False
+
+
+def is_network_path(path: str) -> bool:
+    """Best-effort check via /proc/self/mounts; False where that isn't available"""
+    try:
+        with open("/proc/self/mounts", "r", encoding="utf-8") as f:
+            mounts = [line.split() for line in f]
+    except OSError:
+        return False
+
+    path = os.path.realpath(path)
+    best_mount, best_type = "", None
+    for fields in mounts:
+        if len(fields) < 3:
+            continue
+        mount_point = fields[1].replace("\\040", " ")
+        prefix = mount_point.rstrip("/") + "/"
+        is_parent = path == mount_point or path.startswith(prefix)
+        if is_parent and len(mount_point) > len(best_mount):
+            best_mount, best_type = mount_point, fields[2]
+    return best_type in NETWORK_FILESYSTEMS
+
+
+def compile_patterns(patterns: Optional[List[str]]) -> Optional[re.Pattern]:
+    """Combine glob patterns into one regex, or None if there are none"""
+    if not patterns:
+        return None
+    return re.compile(
+        "|".join(fnmatch.translate(os.path.normcase(p)) for p in patterns)
+    )
+
+
 class DirectoryDiff:
-    def __init__(self):
+    def __init__(
+        self,
+        include: List[str] = None,
+        exclude: List[str] = None,
+        ignore_blank_lines: bool = False,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+    ):
+        self.max_bytes = max_bytes
+        self._include_re = compile_patterns(include)
+        self._exclude_re = compile_patterns(exclude)
+        # Treating blank lines as junk stops difflib from anchoring matches on
+        # them, which can give more readable opcodes, but junk lines are still
+        # absorbed into neighbouring matches so counts and ratios shift
+        self.ignore_blank_lines = ignore_blank_lines
+        # Long files fall back to in-process diffing without git
+        self.has_git = shutil.which("git") is not None
         self.supported_extensions = {
             ".cpp",
             ".c",
@@ -33,73 +176,179 @@ class DirectoryDiff:
             ".py",
             ".pyx",
         }
+        # str.endswith takes a tuple, which is much cheaper than a Path per file
+        self._ext_tuple = tuple(self.supported_extensions)
 
-    def should_compare_file(
-        self, file_path: str, include: List[str] = None, exclude: List[str] = None
-    ) -> bool:
-        if Path(file_path).suffix.lower() not in self.supported_extensions:
-            return False
-        if include and not any(fnmatch.fnmatch(file_path, p) for p in include):
+    def has_supported_extension(self, file_path: str) -> bool:
+        name = os.path.basename(file_path).lower()
+        # Like Path.suffix, a bare ".py" has no stem and so no extension
+        return name.endswith(self._ext_tuple) and name.rfind(".") > 0
+
+    def should_compare_file(self, file_path: str) -> bool:
+        return self.has_supported_extension(file_path) and self.matches_patterns(
+            file_path
+        )
+
+    def matches_patterns(self, file_path: str) -> bool:
+        if self._include_re is None and self._exclude_re is None:
+            return True
+        file_path = os.path.normcase(file_path)
+        if self._include_re and not self._include_re.match(file_path):
             return False
-        if exclude and any(fnmatch.fnmatch(file_path, p) for p in exclude):
+        if self._exclude_re and self._exclude_re.match(file_path):
             return False
         return True
 
-    def get_file_list(
-        self, directory: str, include: List[str] = None, exclude: List[str] = None
-    ) -> Set[str]:
-        files = set()
-        for root, dirs, filenames in os.walk(directory):
-            dirs[:] = [
-                d
-                for d in dirs
-                if not d.startswith(".") and d not in {"__pycache__", "build", "dist"}
-            ]
-
-            for filename in filenames:
-                file_path = Path(root) / filename
-                relative_path = str(file_path.relative_to(directory))
-                if self.should_compare_file(relative_path, include, exclude):
-                    files.add(relative_path)
+    def get_file_list(self, directory: str) -> Dict[str, FileStat]:
+        """Maps each relative path to its stat, taken once during the walk"""
+        files = {}
+        # entry.path is always directory joined with the relative path, so
+        # slicing off this prefix avoids relative_to/relpath per file
+        prefix_len = len(os.path.join(directory, ""))
+        lock = threading.Lock()
+        pending = queue.Queue()
+        pending.put(directory)
+
+        def worker():
+            while True:
+                current = pending.get()
+                if current is None:
+                    return
+                found = []
+                try:
+                    with os.scandir(current) as entries:
+                        for entry in entries:
+                            if entry.is_dir():
+                                # Like os.walk, don't descend into symlinked dirs
+                                if not (
+                                    entry.is_symlink()
+                                    or entry.name.startswith(".")
+                                    or entry.name in SKIP_DIRS
+                                ):
+                                    pending.put(entry.path)
+                                continue
+                            if not self.has_supported_extension(entry.name):
+                                continue
+                            relative_path = entry.path[prefix_len:]
+                            if not self.matches_patterns(relative_path):
+                                continue
+                            try:
+                                st = entry.stat()
+                                found.append(
+                                    (relative_path, (st.st_size, st.st_mtime_ns))
+                                )
+                            except OSError:
+                                found.append((relative_path, None))
+                except OSError:
+                    pass
+                finally:
+                    with lock:
+                        files.update(found)
+                    pending.task_done()
+
+        threads = [threading.Thread(target=worker) for _ in range(WALK_WORKERS)]
+        for thread in threads:
+            thread.start()
+        pending.join()
+        for _ in threads:
+            pending.put(None)
+        for thread in threads:
+            thread.join()
         return files
 
     def is_url(self, path: str) -> bool:
         return path.startswith(("http://", "https://"))
 
+    def git_env(self, repo_url: str) -> Optional[dict]:
+        if "huggingface.co" not in repo_url:
+            return None
+        env = os.environ.copy()
+        env["GIT_LFS_SKIP_SMUDGE"] = "1"
+        return env
+
     def clone_repo(self, repo_url: str, target_dir: str) -> str:
-        clone_args = ["git", "clone", "--depth", "1"]
-        env = None
-
-        if "huggingface.co" in repo_url:
-            env = os.environ.copy()
-            env["GIT_LFS_SKIP_SMUDGE"] = "1"
-            clone_args.extend(["--filter=blob:none"])
-
-        subprocess.run(
-            clone_args + [repo_url, target_dir],
-            check=True,
-            capture_output=True,
-            env=env,
-        )
+        clone_args = ["git", "clone", "--depth", "1", "--single-branch", "--no-tags"]
+        # Partial clone only fetches the blobs the checkout needs; servers that
+        # don't support it normally just warn, but retry plainly if one errors
+        filter_args = ["--filter=blob:none"]
+        env = self.git_env(repo_url)
+
+        try:
+            subprocess.run(
+                clone_args + filter_args + [repo_url, target_dir],
+                check=True,
+                capture_output=True,
+                env=env,
+            )
+        except subprocess.CalledProcessError as e:
+            if b"filter" not in e.stderr:
+                raise
+            shutil.rmtree(target_dir, ignore_errors=True)
+            subprocess.run(
+                clone_args + [repo_url, target_dir],
+                check=True,
+                capture_output=True,
+                env=env,
+            )
         return target_dir
 
-    def resolve_path(self, path: str, subdir: str = "") -> tuple[str, bool]:
+    def refresh_repo(self, repo_url: str, target_dir: str) -> None:
+        """Update a cached shallow clone in place rather than re-cloning"""
+        env = self.git_env(repo_url)
+        for git_args in (
+            ["fetch", "--depth", "1", "origin"],
+            ["reset", "--hard", "FETCH_HEAD"],
+        ):
+            subprocess.run(
+                ["git", "-C", target_dir] + git_args,
+                check=True,
+                capture_output=True,
+                env=env,
+            )
+
+    def repo_cache_key(self, repo_url: str) -> str:
+        # Hash the full URL so same-named repos from different owners or
+        # hosts don't share a clone; keep the name for readable paths
+        repo_name = repo_url.rstrip("/").split("/")[-1].removesuffix(".git")
+        digest = hashlib.sha1(repo_url.encode("utf-8")).hexdigest()[:16]
+        return f"{repo_name}-{digest}"
+
+    def update_repo_index(self, cache_dir: Path, key: str, repo_url: str) -> None:
+        """Record clones in index.json so the cache can be listed and pruned"""
+        index_path = cache_dir / "index.json"
+        with _repo_index_lock:
+            try:
+                with open(index_path, "r", encoding="utf-8") as f:
+                    index = json.load(f)
+            except (OSError, ValueError):
+                index = {}
+            index[key] = {"url": repo_url, "last_used": int(time.time())}
+            tmp_path = index_path.with_name(f"index.json.{os.getpid()}.tmp")
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(index, f, indent=2, sort_keys=True)
+            os.replace(tmp_path, index_path)
+
+    def resolve_path(
+        self, path: str, subdir: str = "", refresh: bool = False
+    ) -> tuple[str, bool]:
         """Returns (resolved_path, is_temp)"""
         if self.is_url(path):
             cache_dir = Path.cwd() / ".repo_cache"
             cache_dir.mkdir(exist_ok=True)
 
-            # Create a safe directory name from the URL
-            repo_name = path.split("/")[-1].replace(".git", "")
-            if "huggingface.co" in path:
-                repo_name = path.split("/")[-2] + "_" + repo_name
+            key = self.repo_cache_key(path)
+            target_dir = cache_dir / key
 
-            target_dir = cache_dir / repo_name
-
-            if not target_dir.exists():
-                cloned_dir = self.clone_repo(path, str(target_dir))
-            else:
-                cloned_dir = str(target_dir)
+            with _clone_locks_guard:
+                clone_lock = _clone_locks.setdefault(key, threading.Lock())
+            with clone_lock:
+                if not target_dir.exists():
+                    cloned_dir = self.clone_repo(path, str(target_dir))
+                else:
+                    cloned_dir = str(target_dir)
+                    if refresh:
+                        self.refresh_repo(path, cloned_dir)
+            self.update_repo_index(cache_dir, key, path)
 
             final_path = os.path.join(cloned_dir, subdir) if subdir else cloned_dir
             return final_path, True
@@ -107,16 +356,63 @@ class DirectoryDiff:
             final_path = os.path.join(path, subdir) if subdir else path
             return final_path, False
 
-    def analyze_files(self, file1: str, file2: str) -> dict:
-        try:
-            with open(file1, "r", encoding="utf-8") as f1:
-                lines1 = f1.readlines()
-            with open(file2, "r", encoding="utf-8") as f2:
-                lines2 = f2.readlines()
-        except Exception:
-            return {"similarity_ratio": 0.0, "additions": 0, "deletions": 0}
-
-        differ = difflib.SequenceMatcher(None, lines1, lines2)
+    def contents_equal(self, file1: str, file2: str, bufsize: int = CHUNK_SIZE) -> bool:
+        """Chunked byte comparison; callers check the sizes match first"""
+        with open(file1, "rb") as f1, open(file2, "rb") as f2:
+            chunks1 = iter(lambda: f1.read(bufsize), b"")
+            chunks2 = iter(lambda: f2.read(bufsize), b"")
+            return all(
+                c1 == c2 for c1, c2 in zip_longest(chunks1, chunks2, fillvalue=b"")
+            )
+
+    def analyze_bytes(
+        self,
+        data1: bytes,
+        data2: bytes,
+        file1: Optional[str] = None,
+        file2: Optional[str] = None,
+    ) -> dict:
+        """Line diff of already-loaded contents; git is used only given paths"""
+        # Bytes skip decoding and newline translation, and hash faster than str
+        lines1 = data1.splitlines(keepends=True)
+        lines2 = data2.splitlines(keepends=True)
+
+        shorter = min(len(lines1), len(lines2))
+        if abs(len(lines1) - len(lines2)) > LENGTH_RATIO_CUTOFF * shorter:
+            return {
+                "similarity_ratio": 0.0,
+                "additions": max(0, len(lines2) - len(lines1)),
+                "deletions": max(0, len(lines1) - len(lines2)),
+            }
+
+        # git has no equivalent of treating blank lines as junk, so honour
+        # --ignore-blank-lines by staying in-process
+        use_git = not self.ignore_blank_lines and file1 and file2
+        if shorter > GIT_DIFF_MIN_LINES and use_git:
+            analysis = self.analyze_files_git(file1, file2, len(lines1), len(lines2))
+            if analysis is not None:
+                return analysis
+
+        return self.analyze_lines_difflib(lines1, lines2)
+
+    def analyze_lines_difflib(self, lines1: List[bytes], lines2: List[bytes]) -> dict:
+        # Most changed files share long unchanged runs at both ends; matching
+        # only the middle keeps difflib's superlinear cost to the edited region
+        limit = min(len(lines1), len(lines2))
+        prefix = 0
+        while prefix < limit and lines1[prefix] == lines2[prefix]:
+            prefix += 1
+        suffix = 0
+        while (
+            suffix < limit - prefix
+            and lines1[len(lines1) - 1 - suffix] == lines2[len(lines2) - 1 - suffix]
+        ):
+            suffix += 1
+        middle1 = lines1[prefix : len(lines1) - suffix]
+        middle2 = lines2[prefix : len(lines2) - suffix]
+
+        isjunk = (lambda line: not line.strip()) if self.ignore_blank_lines else None
+        differ = difflib.SequenceMatcher(isjunk, middle1, middle2, autojunk=False)
         additions = deletions = 0
 
         for tag, i1, i2, j1, j2 in differ.get_opcodes():
@@ -128,76 +424,250 @@ class DirectoryDiff:
                 deletions += i2 - i1
                 additions += j2 - j1
 
+        # Same 2*M/T as SequenceMatcher.ratio(), over the whole files
+        matches = prefix + suffix + sum(b.size for b in differ.get_matching_blocks())
+        total = len(lines1) + len(lines2)
         return {
-            "similarity_ratio": differ.ratio(),
+            "similarity_ratio": 2.0 * matches / total if total else 1.0,
             "additions": additions,
             "deletions": deletions,
         }
 
-    def compare_directories(
-        self, dir1: str, dir2: str, include: List[str] = None, exclude: List[str] = None
-    ) -> dict:
-        files1 = self.get_file_list(dir1, include, exclude)
-        files2 = self.get_file_list(dir2, include, exclude)
-        all_files = files1.union(files2)
-
-        comparisons = []
-        identical = different = only_1 = only_2 = 0
-        total_similarity = valid_similarities = 0
-
-        for rel_path in sorted(all_files):
-            file1_path = Path(dir1) / rel_path
-            file2_path = Path(dir2) / rel_path
-
-            if not file1_path.exists():
-                comparisons.append(FileComparison(rel_path, "only_in_dir2"))
-                only_2 += 1
-            elif not file2_path.exists():
-                comparisons.append(FileComparison(rel_path, "only_in_dir1"))
-                only_1 += 1
-            else:
-                try:
-                    with open(file1_path, "rb") as f1, open(file2_path, "rb") as f2:
-                        if f1.read() == f2.read():
-                            comparisons.append(
-                                FileComparison(rel_path, "identical", 1.0)
-                            )
-                            identical += 1
-                            total_similarity += 1.0
-                            valid_similarities += 1
-                        else:
-                            analysis = self.analyze_files(
-                                str(file1_path), str(file2_path)
-                            )
-                            comp = FileComparison(
-                                rel_path,
-                                "different",
-                                analysis["similarity_ratio"],
-                                analysis["additions"],
-                                analysis["deletions"],
-                            )
-                            comparisons.append(comp)
-                            different += 1
-                            total_similarity += analysis["similarity_ratio"]
-                            valid_similarities += 1
-                except Exception:
-                    comparisons.append(FileComparison(rel_path, "error"))
+    def analyze_files_git(
+        self, file1: str, file2: str, num_lines1: int, num_lines2: int
+    ) -> Optional[dict]:
+        """Counts from `git diff --numstat`, or None if git can't provide them"""
+        try:
+            proc = subprocess.run(
+                ["git", "diff", "--no-index", "--numstat", "--no-color", file1, file2],
+                capture_output=True,
+                text=True,
+            )
+        except OSError:
+            return None
+        # --no-index exits 1 when the files differ; anything else is a failure
+        if proc.returncode not in (0, 1):
+            return None
+
+        fields = proc.stdout.split("\t", 2)
+        if len(fields) < 3 or not (fields[0].isdigit() and fields[1].isdigit()):
+            return None
+        additions, deletions = int(fields[0]), int(fields[1])
+        return {
+            "similarity_ratio": 1 - (additions + deletions) / (num_lines1 + num_lines2),
+            "additions": additions,
+            "deletions": deletions,
+        }
+
+    def cache_key(self, dir1: str, dir2: str, rel_path: str) -> str:
+        # Sizes and mtimes are checked against the entry rather than being
+        # part of the key, so a touched file replaces its entry
+        return json.dumps(
+            [
+                os.path.abspath(dir1),
+                os.path.abspath(dir2),
+                rel_path,
+                # Anything that changes the analysis result belongs in the key
+                self.has_git,
+                self.ignore_blank_lines,
+                self.max_bytes,
+            ]
+        )
+
+    def is_binary(self, data: bytes) -> bool:
+        return b"\0" in data[:BINARY_SNIFF_BYTES]
+
+    def read_bytes(self, path: str) -> bytes:
+        with open(path, "rb") as f:
+            return f.read()
+
+    def compare_file(
+        self,
+        dir1: str,
+        dir2: str,
+        rel_path: str,
+        size1: Optional[int] = None,
+        size2: Optional[int] = None,
+    ) -> FileComparison:
+        file1_path = str(Path(dir1) / rel_path)
+        file2_path = str(Path(dir2) / rel_path)
+        try:
+            if size1 is None or size2 is None:
+                size1 = os.stat(file1_path).st_size
+                size2 = os.stat(file2_path).st_size
+            if max(size1, size2) > self.max_bytes:
+                # Equal large files are still streamed so they count as
+                # identical, without holding either one in memory
+                if size1 == size2 and self.contents_equal(file1_path, file2_path):
+                    return FileComparison(rel_path, "identical", 1.0)
+                return FileComparison(rel_path, "skipped_large")
+            # Small files are read once and the same bytes serve the equality
+            # check, the binary sniff and the line diff
+            data1 = self.read_bytes(file1_path)
+            data2 = self.read_bytes(file2_path)
+            if data1 == data2:
+                return FileComparison(rel_path, "identical", 1.0)
+            if self.is_binary(data1) or self.is_binary(data2):
+                return FileComparison(rel_path, "binary")
+            analysis = self.analyze_bytes(data1, data2, file1_path, file2_path)
+            return FileComparison(
+                rel_path,
+                "different",
+                analysis["similarity_ratio"],
+                analysis["additions"],
+                analysis["deletions"],
+            )
+        except Exception:
+            return FileComparison(rel_path, "error")
+
+    def compare_shared(
+        self,
+        dir1: str,
+        dir2: str,
+        rel_paths: List[str],
+        sizes1: List[Optional[int]],
+        sizes2: List[Optional[int]],
+    ) -> Iterator[FileComparison]:
+        """Yields results in rel_paths order as soon as each one is ready"""
+        if len(rel_paths) <= PARALLEL_THRESHOLD:
+            for p, size1, size2 in zip(rel_paths, sizes1, sizes2):
+                yield self.compare_file(dir1, dir2, p, size1, size2)
+            return
+
+        workers = os.cpu_count() or 1
+        with ProcessPoolExecutor(
+            max_workers=workers, initializer=_init_worker, initargs=(self,)
+        ) as executor:
+            try:
+                yield from executor.map(
+                    _compare_one,
+                    repeat(dir1),
+                    repeat(dir2),
+                    rel_paths,
+                    sizes1,
+                    sizes2,
+                    chunksize=max(1, len(rel_paths) // (workers * 4)),
+                )
+            except GeneratorExit:
+                # map submits every task up front; if the consumer stops
+                # early, drop the queued ones instead of diffing them all
+                executor.shutdown(cancel_futures=True)
+                raise
 
+    def compare_directories(
+        self, dir1: str, dir2: str, cache: Optional[Cache] = None
+    ) -> Iterator[Union[FileComparison, dict]]:
+        """Yields each FileComparison as it is produced, then a summary dict
+
+        Results aren't collected, only cache hits are held until their turn;
+        the file listings themselves are still kept in memory. Shared files
+        come in path order, then the files only present on one side.
+        """
+        files1 = self.get_file_list(dir1)
+        files2 = self.get_file_list(dir2)
+        shared = sorted(files1.keys() & files2.keys())
+
+        counts = dict.fromkeys(
+            ("identical", "different", "error", "skipped_large", "binary"), 0
+        )
+        total_similarity = 0.0
+
+        def tally(comp: FileComparison) -> FileComparison:
+            nonlocal total_similarity
+            counts[comp.status] += 1
+            if comp.status in ("identical", "different"):
+                total_similarity += comp.similarity_ratio
+            return comp
+
+        misses = shared
+        hits: Dict[str, FileComparison] = {}
+        cache_keys = {}
+        use_cache = cache is not None and not (
+            is_network_path(dir1) or is_network_path(dir2)
+        )
+        if use_cache:
+            misses = []
+            for rel_path in shared:
+                stat1, stat2 = files1[rel_path], files2[rel_path]
+                hit = None
+                if stat1 is not None and stat2 is not None:
+                    key = self.cache_key(dir1, dir2, rel_path)
+                    # Lists, since that's how the stats come back from JSON
+                    stamp = [list(stat1), list(stat2)]
+                    hit = cache.get(key, rel_path, stamp)
+                    if hit is None:
+                        cache_keys[rel_path] = (key, stamp)
+                if hit is not None:
+                    hits[rel_path] = hit
+                else:
+                    misses.append(rel_path)
+
+        sizes1 = [files1[p][0] if files1[p] else None for p in misses]
+        sizes2 = [files2[p][0] if files2[p] else None for p in misses]
+        # Misses come back in path order, so merging them with the hits
+        # keeps the whole output sorted
+        computed = self.compare_shared(dir1, dir2, misses, sizes1, sizes2)
+        for rel_path in shared:
+            comp = hits.pop(rel_path, None)
+            if comp is None:
+                comp = next(computed)
+                if rel_path in cache_keys and comp.status != "error":
+                    cache.put(*cache_keys[rel_path], comp)
+            yield tally(comp)
+        # Every result has been taken, so this just lets the pool shut down
+        computed.close()
+        if use_cache:
+            # Files the current filters skip weren't walked, but may still be
+            # there, so only drop entries the filters would have picked up
+            cache.prune(
+                dir1,
+                dir2,
+                lambda p: not (p in files1 and p in files2)
+                and self.should_compare_file(p),
+            )
+
+        only_in_1 = sorted(files1.keys() - files2.keys())
+        only_in_2 = sorted(files2.keys() - files1.keys())
+        for rel_path in only_in_1:
+            yield FileComparison(rel_path, "only_in_dir1")
+        for rel_path in only_in_2:
+            yield FileComparison(rel_path, "only_in_dir2")
+
+        valid_similarities = counts["identical"] + counts["different"]
         avg_similarity = (
             total_similarity / valid_similarities if valid_similarities > 0 else 0
         )
-
-        return {
-            "comparisons": comparisons,
-            "total_files": len(all_files),
-            "identical": identical,
-            "different": different,
-            "only_in_1": only_1,
-            "only_in_2": only_2,
+        yield {
+            "total_files": len(shared) + len(only_in_1) + len(only_in_2),
+            "identical": counts["identical"],
+            "different": counts["different"],
+            "only_in_1": len(only_in_1),
+            "only_in_2": len(only_in_2),
+            "skipped": counts["skipped_large"] + counts["binary"],
             "avg_similarity": avg_similarity,
         }
 
 
+# Each pool worker gets its own copy of the DirectoryDiff via the initializer,
+# so per-task pickling stays down to the three path strings
+_worker_tool: Optional[DirectoryDiff] = None
+
+
+def _init_worker(tool: DirectoryDiff) -> None:
+    global _worker_tool
+    _worker_tool = tool
+
+
+def _compare_one(
+    dir1: str,
+    dir2: str,
+    rel_path: str,
+    size1: Optional[int],
+    size2: Optional[int],
+) -> FileComparison:
+    return _worker_tool.compare_file(dir1, dir2, rel_path, size1, size2)
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="Compare directories or repositories",
@@ -214,63 +684,100 @@ def main():
     parser.add_argument("--subdir2", default="", help="Subdirectory in second source")
     parser.add_argument("--include", nargs="*", help="Include file patterns")
     parser.add_argument("--exclude", nargs="*", help="Exclude file patterns")
+    parser.add_argument(
+        "--ignore-blank-lines",
+        action="store_true",
+        help="Treat blank lines as junk when matching",
+    )
+    parser.add_argument(
+        "--max-bytes",
+        type=int,
+        default=DEFAULT_MAX_BYTES,
+        help="Skip line analysis for files larger than this "
+        f"(default: {DEFAULT_MAX_BYTES})",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Don't reuse or store results from previous runs",
+    )
+    parser.add_argument(
+        "--refresh",
+        action="store_true",
+        help="Fetch the latest commit for already-cached repository clones",
+    )
 
     args = parser.parse_args()
 
-    tool = DirectoryDiff()
+    tool = DirectoryDiff(
+        include=args.include,
+        exclude=args.exclude,
+        ignore_blank_lines=args.ignore_blank_lines,
+        max_bytes=args.max_bytes,
+    )
 
     try:
-        dir1, is_temp1 = tool.resolve_path(args.source1, args.subdir1)
-        dir2, is_temp2 = tool.resolve_path(args.source2, args.subdir2)
+        # Clones are network-bound, so fetch both sources at once
+        with ThreadPoolExecutor(2) as executor:
+            future1 = executor.submit(
+                tool.resolve_path, args.source1, args.subdir1, args.refresh
+            )
+            future2 = executor.submit(
+                tool.resolve_path, args.source2, args.subdir2, args.refresh
+            )
+            (dir1, is_temp1), (dir2, is_temp2) = future1.result(), future2.result()
 
         if not os.path.exists(dir1):
             raise RuntimeError(f"Directory not found: {dir1}")
         if not os.path.exists(dir2):
             raise RuntimeError(f"Directory not found: {dir2}")
 
-        result = tool.compare_directories(dir1, dir2, args.include, args.exclude)
-
-        print(
-            f"Total: {result['total_files']}, "
-            f"Identical: {result['identical']}, "
-            f"Different: {result['different']}, "
-            f"Only in source1: {result['only_in_1']}, "
-            f"Only in source2: {result['only_in_2']}, "
-            f"Avg similarity: {result['avg_similarity']:.2%}"
+        cache = (
+            None
+            if args.no_cache
+            else Cache(Path.cwd() / ".repo_cache" / "compare_cache.json")
         )
 
-        print(f"\n# To git diff these files:")
+        print(f"# To git diff these files:")
         print(f"# git diff --no-index {dir1} {dir2}")
 
-        if result["different"] > 0:
-            print(f"\n# Modified files ({result['different']}):")
-            different_files = [
-                c for c in result["comparisons"] if c.status == "different"
-            ]
-            different_files.sort(key=lambda x: x.similarity_ratio or 0)
-            for comp in different_files:
+        # Results are printed as they arrive, so each section's header goes
+        # out with its first entry and the totals come last
+        headers = {
+            "different": "\n# Modified files:",
+            "only_in_dir1": "\n# Files only in source1:",
+            "only_in_dir2": "\n# Files only in source2:",
+        }
+        for comp in tool.compare_directories(dir1, dir2, cache):
+            if isinstance(comp, dict):
+                result = comp
+                break
+            if comp.status in headers:
+                print(headers.pop(comp.status))
+            if comp.status == "different":
                 sim_str = (
                     f" ({comp.similarity_ratio:.1%})" if comp.similarity_ratio else ""
                 )
                 print(
                     f"git diff --no-index '{dir1}/{comp.path}' '{dir2}/{comp.path}'{sim_str}"
                 )
+            elif comp.status == "only_in_dir1":
+                print(f"# Only in source1: {comp.path}")
+            elif comp.status == "only_in_dir2":
+                print(f"# Only in source2: {comp.path}")
+        if cache is not None:
+            cache.save()
 
-        if result["only_in_1"] > 0:
-            print(f"\n# Files only in source1 ({result['only_in_1']}):")
-            only_1_files = [
-                c.path for c in result["comparisons"] if c.status == "only_in_dir1"
-            ]
-            for path in only_1_files:
-                print(f"# Only in source1: {path}")
-
-        if result["only_in_2"] > 0:
-            print(f"\n# Files only in source2 ({result['only_in_2']}):")
-            only_2_files = [
-                c.path for c in result["comparisons"] if c.status == "only_in_dir2"
-            ]
-            for path in only_2_files:
-                print(f"# Only in source2: {path}")
+        print(
+            f"\nTotal: {result['total_files']}, "
+            f"Identical: {result['identical']}, "
+            f"Different: {result['different']}, "
+            f"Only in source1: {result['only_in_1']}, "
+            f"Only in source2: {result['only_in_2']}, "
+            f"Avg similarity: {result['avg_similarity']:.2%}"
+        )
+        if result["skipped"] > 0:
+            print(f"Skipped {result['skipped']} large/binary files")
 
     except Exception as e:
         print(f"Error: {e}")